@@ -1,25 +1,162 @@
 # app/auth.py
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime, timedelta
-from jose import JWTError, jwt
+import jwt
+from cachetools import TTLCache
 import bcrypt
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from sqlalchemy.orm import Session
-from app.database import SessionLocal, User, APIKey
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.database import SessionLocal, USER_BY_ID_SQL, API_KEY_USER_ID_SQL, fetch_row
+from app.rate_limiter import limit_for_tier, max_concurrent_for_tier
+import hashlib
+import hmac
+import logging
+import math
+import platform
+import os
 import secrets
+import threading
+import time
 
 SECRET_KEY = "your-secret-key-change-in-production"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
+# API keys are stored as HMAC-SHA256(pepper, key), never in the clear. The
+# fallback is the constant above, not a SECRET_KEY environment variable.
+API_KEY_PEPPER = os.getenv("API_KEY_PEPPER", SECRET_KEY).encode()
+
+# Verified tokens are reused for a few seconds to skip crypto + DB on the hot path
+TOKEN_CACHE_TTL = float(os.getenv("TOKEN_CACHE_TTL", "5"))
+# Users and API keys change rarely; cache them longer and invalidate explicitly
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "60"))
+
+# bcrypt cost is the largest one that hashes within this budget on the host
+BCRYPT_MAX_MS = float(os.getenv("BCRYPT_MAX_MS", "150"))
+
 security = HTTPBearer()
 
-def get_db():
-    db = SessionLocal()
+logger = logging.getLogger(__name__)
+
+# Keyed HMAC state is set up once; per-request hashing only copies it
+_API_KEY_HMAC = hmac.new(API_KEY_PEPPER, digestmod=hashlib.sha256)
+
+def _sha256_hw_accelerated() -> bool:
+    """Best-effort check that hashlib's OpenSSL SHA-256 can use CPU SHA extensions"""
+    if hashlib.sha256.__module__ != "_hashlib":
+        return False  # Pure builtin implementation, OpenSSL not linked
+    flag = {"x86_64": "sha_ni", "amd64": "sha_ni", "aarch64": "sha2", "arm64": "sha2"}.get(
+        platform.machine().lower()
+    )
     try:
+        with open("/proc/cpuinfo") as f:
+            return flag is not None and flag in f.read().split()
+    except OSError:
+        return False
+
+SHA256_HW_ACCELERATED = _sha256_hw_accelerated()
+if not SHA256_HW_ACCELERATED:
+    logger.warning("SHA-256 hardware acceleration not detected; token hashing uses software SHA-256")
+
+# bcrypt releases the GIL, so hashing on threads keeps the event loop responsive
+BCRYPT_POOL = ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix="bcrypt")
+
+def _benchmark_bcrypt_rounds(max_ms: float) -> int:
+    """Pick the highest cost in 10..14 whose average hash time fits max_ms"""
+    rounds = 10
+    for cost in range(10, 15):
+        salt = bcrypt.gensalt(cost)
+        start = time.perf_counter()
+        for _ in range(3):
+            bcrypt.hashpw(b"x", salt)
+        elapsed_ms = (time.perf_counter() - start) * 1000 / 3
+        if elapsed_ms > max_ms:
+            break
+        rounds = cost
+    return rounds
+
+# Set BCRYPT_ROUNDS to skip the startup benchmark
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS") or _benchmark_bcrypt_rounds(BCRYPT_MAX_MS))
+
+@dataclass(frozen=True, slots=True)
+class AuthenticatedUser:
+    """Detached snapshot of the user fields read by endpoints and the rate limiter"""
+    id: int
+    tier: str
+    email: str
+    rate_limit: int  # Requests per minute for the user's tier
+    max_concurrent: int  # Requests in flight at once for the user's tier
+
+# hash_api_key(token) -> (AuthenticatedUser, expires_at). Only successful lookups are stored.
+_token_cache = TTLCache(maxsize=10000, ttl=TOKEN_CACHE_TTL)
+# user_id -> AuthenticatedUser
+_user_cache = TTLCache(maxsize=5000, ttl=USER_CACHE_TTL)
+# hash_api_key(api_key) -> user_id, so raw keys are never held in memory
+_apikey_cache = TTLCache(maxsize=5000, ttl=USER_CACHE_TTL)
+_cache_lock = threading.Lock()
+
+def _get_cached_user(key: bytes):
+    with _cache_lock:
+        entry = _token_cache.get(key)
+    if entry is None:
+        return None
+    user, expires_at = entry
+    # Never serve a JWT past its own exp, even if the cache TTL is longer
+    if expires_at <= time.time():
+        return None
+    return user
+
+def _cache_user(key: bytes, user: AuthenticatedUser, expires_at: float) -> AuthenticatedUser:
+    with _cache_lock:
+        _token_cache[key] = (user, expires_at)
+    return user
+
+async def _load_user(db: AsyncSession, user_id: int) -> AuthenticatedUser:
+    with _cache_lock:
+        cached = _user_cache.get(user_id)
+    if cached is not None:
+        return cached
+    
+    row = await fetch_row(db, USER_BY_ID_SQL, user_id)
+    if row is None:
+        raise HTTPException(status_code=401, detail="User not found")
+    
+    cached = AuthenticatedUser(
+        id=row["id"],
+        tier=row["tier"],
+        email=row["email"],
+        rate_limit=limit_for_tier(row["tier"]),
+        max_concurrent=max_concurrent_for_tier(row["tier"])
+    )
+    with _cache_lock:
+        _user_cache[user_id] = cached
+    return cached
+
+def invalidate_user(user_id: int):
+    """Drop cached state for a user, e.g. after a tier change"""
+    with _cache_lock:
+        _user_cache.pop(user_id, None)
+        stale = [key for key, (user, _) in _token_cache.items() if user.id == user_id]
+        for key in stale:
+            _token_cache.pop(key, None)
+
+def invalidate_api_key(key_hash: bytes):
+    """Drop cached state for an API key by its stored APIKey.key_hash, e.g. after it is revoked"""
+    with _cache_lock:
+        _apikey_cache.pop(key_hash, None)
+        _token_cache.pop(key_hash, None)
+
+async def get_db(request: Request):
+    """Yield the session opened by the middleware, or a fresh one"""
+    db = getattr(request.state, "db", None)
+    if db is not None:
+        yield db
+        return
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 def create_access_token(data: dict):
     to_encode = data.copy()
@@ -30,53 +167,90 @@ def create_access_token(data: dict):
         to_encode["sub"] = str(to_encode["sub"])
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
     """Verify password against hash"""
-    return bcrypt.checkpw(
+    return await asyncio.get_running_loop().run_in_executor(
+        BCRYPT_POOL,
+        bcrypt.checkpw,
         plain_password.encode('utf-8'),
         hashed_password.encode('utf-8')
     )
 
-def get_password_hash(password: str) -> str:
+async def get_password_hash(password: str) -> str:
     """Hash a password"""
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    hashed = await asyncio.get_running_loop().run_in_executor(
+        BCRYPT_POOL,
+        bcrypt.hashpw,
+        password.encode('utf-8'),
+        bcrypt.gensalt(BCRYPT_ROUNDS)
+    )
+    return hashed.decode('utf-8')
 
 def generate_api_key() -> str:
     """Generate OpenAI-style API key: sk-..."""
     return f"sk-{secrets.token_urlsafe(32)}"
 
+def hash_api_key(api_key: str) -> bytes:
+    """Fixed-width digest stored and indexed in place of the raw key"""
+    h = _API_KEY_HMAC.copy()
+    h.update(api_key.encode())
+    return h.digest()
+
 async def get_current_user(
     credentials: HTTPAuthorizationCredentials = Depends(security),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Validate JWT or API key and return user"""
     token = credentials.credentials
+    cache_key = hash_api_key(token)
+    
+    cached = _get_cached_user(cache_key)
+    if cached is not None:
+        return cached
     
     # Try JWT first
     if not token.startswith("sk-"):
         try:
-            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+            payload = jwt.decode(
+                token,
+                SECRET_KEY,
+                algorithms=[ALGORITHM],
+                options={"require": ["exp", "sub"]}
+            )
             user_id: int = int(payload.get("sub")) 
             if user_id is None:
                 raise HTTPException(status_code=401, detail="Invalid token")
-            user = db.query(User).filter(User.id == user_id).first()
-            if user is None:
-                raise HTTPException(status_code=401, detail="User not found")
-            return user
-        except JWTError:
+            user = await _load_user(db, user_id)
+            return _cache_user(cache_key, user, payload["exp"])
+        except jwt.PyJWTError:
             raise HTTPException(status_code=401, detail="Invalid token")
     
     # Try API key
-    api_key = db.query(APIKey).filter(
-        APIKey.key == token,
-        APIKey.is_active == True
-    ).first()
+    with _cache_lock:
+        user_id = _apikey_cache.get(cache_key)
     
-    if not api_key:
-        raise HTTPException(status_code=401, detail="Invalid API key")
+    if user_id is None:
+        row = await fetch_row(db, API_KEY_USER_ID_SQL, cache_key)
+        
+        if row is None:
+            raise HTTPException(status_code=401, detail="Invalid API key")
+        
+        user_id = row["user_id"]
+        with _cache_lock:
+            _apikey_cache[cache_key] = user_id
     
-    user = db.query(User).filter(User.id == api_key.user_id).first()
-    if not user:
-        raise HTTPException(status_code=401, detail="User not found")
+    user = await _load_user(db, user_id)
     
-    return user
\ No newline at end of file
+    # API keys don't expire on their own; the cache TTL bounds revocation lag
+    return _cache_user(cache_key, user, math.inf)
+
+async def get_current_user_dep(
+    request: Request,
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+    db: AsyncSession = Depends(get_db)
+):
+    """Return the user already resolved by the middleware, or validate now"""
+    user = getattr(request.state, "user", None)
+    if user is not None:
+        return user
+    return await get_current_user(credentials, db)
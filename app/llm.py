@@ -1,40 +1,37 @@
 # app/llm.py
-import time
 import uuid
 from typing import Generator
 
+# Simulated delay between streamed tokens; pacing is left to the caller
+STREAM_TOKEN_INTERVAL = 0.05
+
+def _mock_response(messages: list) -> str:
+    """Pick a mock reply, lowercasing the prompt once for keyword dispatch"""
+    # Build a simple prompt from messages
+    prompt = messages[-1].content if messages else "Hello"
+    lowered = prompt.lower()
+    
+    if "python" in lowered:
+        return "Here's a Python example: def hello(): print('Hello, World!')"
+    elif "joke" in lowered:
+        return "Why do programmers prefer dark mode? Because light attracts bugs! 🐛"
+    else:
+        return f"This is a mock response to: {prompt[:50]}. In production, this would stream from a real LLM."
+
 def mock_llm_stream(messages: list, model: str) -> Generator[str, None, None]:
     """
     Simulate streaming LLM response
     In production, this would call OpenAI/Anthropic API
     """
-    # Build a simple prompt from messages
-    prompt = messages[-1]["content"] if messages else "Hello"
-    
-    # Mock response based on prompt
-    if "python" in prompt.lower():
-        response = "Here's a Python example: def hello(): print('Hello, World!')"
-    elif "joke" in prompt.lower():
-        response = "Why do programmers prefer dark mode? Because light attracts bugs! 🐛"
-    else:
-        response = f"This is a mock response to: {prompt[:50]}. In production, this would stream from a real LLM."
+    response = _mock_response(messages)
     
     # Stream word by word
     words = response.split()
     for word in words:
-        time.sleep(0.05)  # Simulate network delay
         yield word + " "
 
 def mock_llm_complete(messages: list, model: str) -> str:
     """
     Simulate non-streaming LLM response
     """
-    time.sleep(0.5)  # Simulate processing
-    prompt = messages[-1]["content"] if messages else "Hello"
-    
-    if "python" in prompt.lower():
-        return "Here's a Python example: def hello(): print('Hello, World!')"
-    elif "joke" in prompt.lower():
-        return "Why do programmers prefer dark mode? Because light attracts bugs! 🐛"
-    else:
-        return f"This is a mock response to: {prompt[:50]}. In production, this would stream from a real LLM."
\ No newline at end of file
+    return _mock_response(messages)
\ No newline at end of file
@@ -1,41 +1,67 @@
 # app/main.py
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Depends, HTTPException, Request
-from fastapi.responses import JSONResponse, StreamingResponse
-from sqlalchemy.orm import Session
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.auth import (
     create_access_token,
     verify_password,
+    get_password_hash,
     get_current_user,
+    get_current_user_dep,
+    AuthenticatedUser,
     generate_api_key,
+    hash_api_key,
     get_db,
     security
 )
-from app.database import User, APIKey
+from app.database import SessionLocal, User, APIKey, DB_AUTO_CREATE, engine, init_db
 from app.models import LoginRequest, LoginResponse, APIKeyCreate, APIKeyResponse, ChatRequest, Message
-from app.rate_limiter import RateLimiter
+from app.rate_limiter import RateLimiter, ConcurrencyLimiter
 from fastapi.security import HTTPAuthorizationCredentials
-from app.llm import mock_llm_stream, mock_llm_complete
-import json
+from app.llm import mock_llm_stream, mock_llm_complete, STREAM_TOKEN_INTERVAL
+import asyncio
+import orjson
 import uuid
 import time as time_module
 
-app = FastAPI(title="Chat API Gateway")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if DB_AUTO_CREATE:
+        await init_db()
+    yield
+    await engine.dispose()
+
+app = FastAPI(
+    title="Chat API Gateway",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
+)
+
+# Skip rate limiting ONLY for these specific paths
+SKIP_PATHS = frozenset({
+    "/",
+    "/docs",
+    "/openapi.json",
+    "/redoc",
+    "/v1/auth/login",
+    "/v1/auth/api-keys"
+})
+
+async def _release_after(body_iterator, release):
+    """Pass the body through, releasing the concurrency slot once it is sent"""
+    try:
+        async for chunk in body_iterator:
+            yield chunk
+    finally:
+        release()
 
 @app.middleware("http")
 async def rate_limit_middleware(request: Request, call_next):
     """Rate limit all requests except auth endpoints"""
     
-    # Skip rate limiting ONLY for these specific paths
-    skip_paths = [
-        "/",
-        "/docs",
-        "/openapi.json",
-        "/redoc",
-        "/v1/auth/login",
-        "/v1/auth/api-keys"
-    ]
-    
-    if request.url.path in skip_paths:
+    if request.scope["path"] in SKIP_PATHS:
         return await call_next(request)
     
     # Get Authorization header
@@ -43,28 +69,29 @@ async def rate_limit_middleware(request: Request, call_next):
     if not auth_header or not auth_header.startswith("Bearer "):
         return await call_next(request)
     
+    # One session per request, shared with the endpoint via get_db
+    db = SessionLocal()
+    request.state.db = db
+    
     try:
-        # Extract token
-        token = auth_header.replace("Bearer ", "")
-        credentials = HTTPAuthorizationCredentials(
-            scheme="Bearer",
-            credentials=token
-        )
-        
-        # Get database session
-        db_gen = get_db()
-        db = next(db_gen)
-        
         try:
+            # Extract token
+            token = auth_header[7:]
+            credentials = HTTPAuthorizationCredentials(
+                scheme="Bearer",
+                credentials=token
+            )
+            
             # Validate user
             user = await get_current_user(credentials, db)
+            request.state.user = user
             
             # Check rate limit
-            limiter = RateLimiter(tier=user.tier, user_id=user.id)
+            limiter = RateLimiter(user_id=user.id, limit=user.rate_limit)
             allowed, info = limiter.check()
             
             if not allowed:
-                return JSONResponse(
+                return ORJSONResponse(
                     status_code=429,
                     content={
                         "error": info["error"],
@@ -77,71 +104,93 @@ async def rate_limit_middleware(request: Request, call_next):
                     }
                 )
             
-            # Add rate limit headers to response
+            # Cap requests in flight for this user
+            concurrency = ConcurrencyLimiter(user_id=user.id, limit=user.max_concurrent)
+            if not concurrency.acquire():
+                return ORJSONResponse(
+                    status_code=429,
+                    content={
+                        "error": "Concurrent request limit exceeded",
+                        "detail": f"Too many requests in flight. At most {concurrency.limit} allowed at once."
+                    },
+                    headers={"Retry-After": "1"}
+                )
+                
+        except Exception as e:
+            # If auth or limiting fails, let the request through (fail open)
+            return await call_next(request)
+        
+        # Endpoint errors propagate once; they are not retried by the fail-open path.
+        # Any exit before the body takes over the slot, cancellation included, releases it.
+        handed_off = False
+        try:
             response = await call_next(request)
-            response.headers["X-RateLimit-Limit"] = str(info["limit"])
-            response.headers["X-RateLimit-Remaining"] = str(info["remaining"])
-            return response
-            
+            # Streaming bodies are sent after call_next returns
+            response.body_iterator = _release_after(response.body_iterator, concurrency.release)
+            handed_off = True
         finally:
-            db.close()
-            
-    except Exception as e:
-        # If anything fails, let the request through (fail open)
-        return await call_next(request)
+            if not handed_off:
+                concurrency.release()
+        
+        # Add rate limit headers to response
+        response.headers["X-RateLimit-Limit"] = str(info["limit"])
+        response.headers["X-RateLimit-Remaining"] = str(info["remaining"])
+        return response
+    
+    finally:
+        await db.close()
 
 @app.get("/")
 async def root():
     return {"message": "Chat API Gateway", "status": "running"}
 
 @app.post("/v1/auth/login", response_model=LoginResponse)
-async def login(request: LoginRequest, db: Session = Depends(get_db)):
+async def login(request: LoginRequest, db: AsyncSession = Depends(get_db)):
     """Login with email/password, get JWT"""
-    user = db.query(User).filter(User.email == request.email).first()
-    if not user or not verify_password(request.password, user.hashed_password):
+    user = await db.scalar(select(User).where(User.email == request.email))
+    if not user or not await verify_password(request.password, user.hashed_password):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
     access_token = create_access_token(data={"sub": user.id})
     return LoginResponse(access_token=access_token)
 
 @app.post("/v1/auth/signup")
-async def signup(request: LoginRequest, db: Session = Depends(get_db)):
+async def signup(request: LoginRequest, db: AsyncSession = Depends(get_db)):
     """Create new user account"""
-    import bcrypt
-    
-    existing = db.query(User).filter(User.email == request.email).first()
+    existing = await db.scalar(select(User).where(User.email == request.email))
     if existing:
         raise HTTPException(status_code=400, detail="Email already registered")
     
     user = User(
         email=request.email,
-        hashed_password=bcrypt.hashpw(request.password.encode(), bcrypt.gensalt()).decode(),
+        hashed_password=await get_password_hash(request.password),
         tier="free"
     )
     db.add(user)
-    db.commit()
+    await db.commit()
     
     return {"message": "User created successfully", "email": user.email}
 
 @app.post("/v1/auth/api-keys", response_model=APIKeyResponse)
 async def create_api_key(
     request: APIKeyCreate,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: AuthenticatedUser = Depends(get_current_user_dep),
+    db: AsyncSession = Depends(get_db)
 ):
     """Create a new API key for authenticated user"""
     key = generate_api_key()
     api_key = APIKey(
-        key=key,
+        key_hash=hash_api_key(key),
+        key_prefix=key[:8],
         user_id=current_user.id,
         name=request.name
     )
     db.add(api_key)
-    db.commit()
+    await db.commit()
     return APIKeyResponse(api_key=key, name=request.name)
 
 @app.get("/v1/auth/me")
-async def get_me(current_user: User = Depends(get_current_user)):
+async def get_me(current_user: AuthenticatedUser = Depends(get_current_user_dep)):
     """Get current authenticated user info"""
     return {
         "id": current_user.id,
@@ -152,50 +201,44 @@ async def get_me(current_user: User = Depends(get_current_user)):
 @app.post("/v1/chat/completions")
 async def chat_completions(
     request: ChatRequest,
-    current_user: User = Depends(get_current_user)
+    current_user: AuthenticatedUser = Depends(get_current_user_dep)
 ):
     """
     OpenAI-compatible chat completions endpoint
     Supports both streaming and non-streaming responses
     """
-    
-    # Convert Pydantic messages to dicts
-    messages = [{"role": m.role, "content": m.content} for m in request.messages]
+    messages = request.messages
     
     # Streaming response
     if request.stream:
-        def generate():
-            chunk_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+        async def generate():
+            # Every frame shares this envelope; per token only the content
+            # string is encoded and spliced between prefix and suffix
+            head = (
+                b'data: {"id":"%s","object":"chat.completion.chunk","created":%d,'
+                b'"model":%s,"choices":[{"index":0,"delta":'
+            ) % (
+                f"chatcmpl-{uuid.uuid4().hex[:24]}".encode(),
+                int(time_module.time()),
+                orjson.dumps(request.model)
+            )
+            prefix = head + b'{"content":'
+            suffix = b'},"finish_reason":null}]}\n\n'
+            
+            # Pace tokens against a monotonic deadline; sleeping parks this
+            # stream on the event loop instead of blocking the worker
+            loop = asyncio.get_running_loop()
+            deadline = loop.time()
             
             # Stream tokens
             for token in mock_llm_stream(messages, request.model):
-                chunk = {
-                    "id": chunk_id,
-                    "object": "chat.completion.chunk",
-                    "created": int(time_module.time()),
-                    "model": request.model,
-                    "choices": [{
-                        "index": 0,
-                        "delta": {"content": token},
-                        "finish_reason": None
-                    }]
-                }
-                yield f"data: {json.dumps(chunk)}\n\n"
+                deadline += STREAM_TOKEN_INTERVAL
+                await asyncio.sleep(max(0, deadline - loop.time()))
+                yield prefix + orjson.dumps(token) + suffix
             
             # Final chunk
-            final_chunk = {
-                "id": chunk_id,
-                "object": "chat.completion.chunk",
-                "created": int(time_module.time()),
-                "model": request.model,
-                "choices": [{
-                    "index": 0,
-                    "delta": {},
-                    "finish_reason": "stop"
-                }]
-            }
-            yield f"data: {json.dumps(final_chunk)}\n\n"
-            yield "data: [DONE]\n\n"
+            yield head + b'{},"finish_reason":"stop"}]}\n\n'
+            yield b"data: [DONE]\n\n"
         
         return StreamingResponse(
             generate(),
@@ -208,6 +251,10 @@ async def chat_completions(
     
     # Non-streaming response
     response_text = mock_llm_complete(messages, request.model)
+    
+    # Whitespace-delimited token estimate, each text split once
+    prompt_tokens = sum(len(m.content.split()) for m in messages)
+    completion_tokens = len(response_text.split())
     response = {
         "id": f"chatcmpl-{uuid.uuid4().hex[:24]}",
         "object": "chat.completion",
@@ -222,9 +269,9 @@ async def chat_completions(
             "finish_reason": "stop"
         }],
         "usage": {
-            "prompt_tokens": sum(len(m["content"].split()) for m in messages),
-            "completion_tokens": len(response_text.split()),
-            "total_tokens": sum(len(m["content"].split()) for m in messages) + len(response_text.split())
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens
         }
     }
     
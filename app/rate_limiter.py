@@ -1,97 +1,153 @@
 # app/rate_limiter.py
 import redis
-import time
 import os
+import secrets
 from typing import Tuple
 
 # Use environment variable in production
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
 redis_client = redis.from_url(REDIS_URL, decode_responses=True)
 
+# Token bucket update for the user and global buckets, run atomically inside Redis:
+# - Tokens refill at constant rate (limit per minute)
+# - Each request consumes 1 token
+# - Bucket capacity = limit
+# State is integer millitokens and milliseconds from the Redis clock, so there
+# is no float parsing and no clock skew between app servers.
+# The global bucket is only charged if the user bucket allows the request.
+# Returns {allowed, remaining, limit_hit} where limit_hit is "user", "global" or "".
+RATE_LIMIT_LUA = """
+local time = redis.call('TIME')
+local now_ms = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+
+local function check_bucket(key, limit)
+    local capacity = limit * 1000
+    local state = redis.call('HMGET', key, 'tokens_milli', 'last_refill_ms')
+    local tokens = tonumber(state[1])
+    local last_refill = tonumber(state[2])
+    if tokens == nil then
+        tokens = capacity
+        last_refill = now_ms
+    end
+
+    -- limit tokens per 60000 ms == limit / 60 millitokens per ms
+    tokens = math.min(capacity, tokens + math.floor((now_ms - last_refill) * limit / 60))
+
+    local allowed = 0
+    if tokens >= 1000 then
+        tokens = tokens - 1000
+        allowed = 1
+        redis.call('HSET', key, 'tokens_milli', tokens, 'last_refill_ms', now_ms)
+    end
+    redis.call('PEXPIRE', key, 60000)
+
+    return allowed, math.floor(tokens / 1000)
+end
+
+local user_allowed, user_remaining = check_bucket(KEYS[1], tonumber(ARGV[1]))
+if user_allowed == 0 then
+    return {0, user_remaining, 'user'}
+end
+
+local global_allowed, global_remaining = check_bucket(KEYS[2], tonumber(ARGV[2]))
+if global_allowed == 0 then
+    return {0, global_remaining, 'global'}
+end
+
+return {1, user_remaining, ''}
+"""
+
+# Script objects call EVALSHA and transparently SCRIPT LOAD again on NoScriptError
+rate_limit_script = redis_client.register_script(RATE_LIMIT_LUA)
+
+# In-flight requests per user, one sorted-set member per request scored by
+# start time (ms, Redis clock). Members older than a minute are treated as
+# leaked and swept before counting. Returns 1 if the request may start.
+CONCURRENCY_LUA = """
+local time = redis.call('TIME')
+local now_ms = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now_ms - 60000)
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[1]) then
+    return 0
+end
+
+redis.call('ZADD', KEYS[1], now_ms, ARGV[2])
+redis.call('PEXPIRE', KEYS[1], 60000)
+return 1
+"""
+
+concurrency_script = redis_client.register_script(CONCURRENCY_LUA)
+
+# Tier limits (requests per minute)
+TIER_LIMITS = {
+    "free": 10,
+    "pro": 100,
+    "enterprise": 1000
+}
+GLOBAL_LIMIT = 10000  # Global limit across all users
+
+# Tier limits (requests in flight at once)
+MAX_CONCURRENT = {
+    "free": 2,
+    "pro": 20,
+    "enterprise": 200
+}
+
+def limit_for_tier(tier: str) -> int:
+    """Per-minute limit for a tier, resolved once when the user is loaded"""
+    return TIER_LIMITS.get(tier, TIER_LIMITS["free"])
+
+def max_concurrent_for_tier(tier: str) -> int:
+    """In-flight request cap for a tier, resolved once when the user is loaded"""
+    return MAX_CONCURRENT.get(tier, MAX_CONCURRENT["free"])
+
 class RateLimiter:
     """Token bucket rate limiter with Redis"""
     
-    # Tier limits (requests per minute)
-    LIMITS = {
-        "free": 10,
-        "pro": 100,
-        "enterprise": 1000,
-        "global": 10000  # Global limit across all users
-    }
-    
-    def __init__(self, tier: str, user_id: int):
-        self.tier = tier
+    def __init__(self, user_id: int, limit: int):
         self.user_id = user_id
+        self.limit = limit
         self.user_key = f"rate_limit:user:{user_id}"
         self.global_key = "rate_limit:global"
     
-    def _check_bucket(self, key: str, limit: int) -> Tuple[bool, dict]:
-        """
-        Token bucket algorithm:
-        - Tokens refill at constant rate (limit per minute)
-        - Each request consumes 1 token
-        - Bucket capacity = limit
-        """
-        now = time.time()
-        
-        # Get current state
-        pipe = redis_client.pipeline()
-        pipe.hgetall(key)
-        result = pipe.execute()[0]
-        
-        if not result:
-            # First request - initialize bucket
-            tokens = limit - 1
-            redis_client.hset(key, mapping={
-                "tokens": tokens,
-                "last_refill": now
-            })
-            redis_client.expire(key, 60)  # Auto-cleanup
-            return True, {"remaining": tokens, "limit": limit}
-        
-        # Calculate token refill
-        tokens = float(result["tokens"])
-        last_refill = float(result["last_refill"])
-        time_passed = now - last_refill
-        refill_rate = limit / 60.0  # tokens per second
-        tokens_to_add = time_passed * refill_rate
-        tokens = min(limit, tokens + tokens_to_add)
-        
-        # Check if request allowed
-        if tokens >= 1:
-            tokens -= 1
-            redis_client.hset(key, mapping={
-                "tokens": tokens,
-                "last_refill": now
-            })
-            return True, {"remaining": int(tokens), "limit": limit}
-        else:
-            return False, {"remaining": 0, "limit": limit}
-    
     def check(self) -> Tuple[bool, dict]:
         """Check both user and global rate limits"""
-        # Check user limit
-        user_limit = self.LIMITS.get(self.tier, self.LIMITS["free"])
-        user_allowed, user_info = self._check_bucket(self.user_key, user_limit)
+        allowed, remaining, limit_hit = rate_limit_script(
+            keys=[self.user_key, self.global_key],
+            args=[self.limit, GLOBAL_LIMIT]
+        )
         
-        if not user_allowed:
+        if limit_hit == "user":
             return False, {
                 "error": "User rate limit exceeded",
                 "retry_after": 60,
-                **user_info
+                "remaining": remaining,
+                "limit": self.limit
             }
         
-        # Check global limit
-        global_allowed, global_info = self._check_bucket(
-            self.global_key,
-            self.LIMITS["global"]
-        )
-        
-        if not global_allowed:
+        if limit_hit == "global":
             return False, {
                 "error": "Global rate limit exceeded",
                 "retry_after": 60,
-                **global_info
+                "remaining": remaining,
+                "limit": GLOBAL_LIMIT
             }
         
-        return True, user_info
\ No newline at end of file
+        return True, {"remaining": remaining, "limit": self.limit}
+
+class ConcurrencyLimiter:
+    """Caps a user's in-flight requests with a Redis sorted set"""
+    
+    def __init__(self, user_id: int, limit: int):
+        self.limit = limit
+        self.key = f"concurrency:user:{user_id}"
+        self.request_id = secrets.token_hex(8)
+    
+    def acquire(self) -> bool:
+        """Register this request; False if the user is already at the cap"""
+        return concurrency_script(keys=[self.key], args=[self.limit, self.request_id]) == 1
+    
+    def release(self):
+        """Mark this request as finished"""
+        redis_client.zrem(self.key, self.request_id)
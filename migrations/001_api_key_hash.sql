@@ -0,0 +1,37 @@
+-- Store API keys as HMAC-SHA256(pepper, key) alongside the raw secret.
+-- The pepper must match the app's API_KEY_PEPPER. If that is unset the app
+-- falls back to the hardcoded SECRET_KEY constant in app/auth.py, not to a
+-- SECRET_KEY environment variable:
+--   psql "$DATABASE_URL" -v pepper="$API_KEY_PEPPER" -f migrations/001_api_key_hash.sql
+-- The plaintext column is dropped separately by 003 once keys are verified.
+\set ON_ERROR_STOP on
+\if :{?pepper}
+\else
+\set pepper ''
+\endif
+BEGIN;
+
+-- An empty pepper would backfill hashes no running app can match. \gset keeps
+-- the secret out of psql's output.
+SELECT set_config('migration.pepper', :'pepper', true) AS pepper \gset
+DO $$
+BEGIN
+    IF current_setting('migration.pepper') = '' THEN
+        RAISE EXCEPTION 'pepper is empty; run with -v pepper="$API_KEY_PEPPER"';
+    END IF;
+END
+$$;
+
+CREATE EXTENSION IF NOT EXISTS pgcrypto;
+
+ALTER TABLE api_keys ADD COLUMN IF NOT EXISTS key_hash BYTEA;
+ALTER TABLE api_keys ADD COLUMN IF NOT EXISTS key_prefix VARCHAR(12);
+
+UPDATE api_keys
+SET key_hash = hmac(key, :'pepper', 'sha256'),
+    key_prefix = left(key, 8)
+WHERE key_hash IS NULL;
+
+CREATE UNIQUE INDEX IF NOT EXISTS ix_api_keys_key_hash ON api_keys (key_hash);
+
+COMMIT;
@@ -0,0 +1,17 @@
+-- Partial unique index for active API key lookups and a covering index for
+-- user lookups. CONCURRENTLY keeps writes flowing, so run this file outside a
+-- transaction (psql's default autocommit):
+--   psql "$DATABASE_URL" -f migrations/002_auth_indexes.sql
+\set ON_ERROR_STOP on
+
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS ix_api_keys_key_hash_active
+    ON api_keys (key_hash) WHERE is_active;
+DROP INDEX CONCURRENTLY IF EXISTS ix_api_keys_key_hash;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_id_cover
+    ON users (id) INCLUDE (tier, email, hashed_password);
+DROP INDEX CONCURRENTLY IF EXISTS ix_users_id;
+
+-- Index-only scans skip the heap only for pages marked all-visible
+VACUUM (ANALYZE) users;
+VACUUM (ANALYZE) api_keys;
@@ -0,0 +1,12 @@
+-- Drop the plaintext API key column left in place by 001. Run this only after
+-- the app is deployed with the same API_KEY_PEPPER used for the backfill and
+-- existing keys authenticate; until then a wrong pepper can still be fixed by
+-- recomputing key_hash from key.
+--   psql "$DATABASE_URL" -f migrations/003_drop_api_key_plaintext.sql
+\set ON_ERROR_STOP on
+BEGIN;
+
+DROP INDEX IF EXISTS ix_api_keys_key;
+ALTER TABLE api_keys DROP COLUMN IF EXISTS key;
+
+COMMIT;
@@ -0,0 +1,329 @@
+# tests/test_api.py
+import os
+import tempfile
+
+# Configure the app before importing it: throwaway DB, fixed bcrypt cost,
+# and an in-process Redis with Lua support in place of a real server
+os.environ.setdefault("DATABASE_URL", f"sqlite+aiosqlite:///{tempfile.mkdtemp()}/test.db")
+os.environ.setdefault("BCRYPT_ROUNDS", "4")
+
+import fakeredis
+import redis
+
+redis.from_url = lambda *args, **kwargs: fakeredis.FakeRedis(decode_responses=True)
+
+import asyncio
+import hashlib
+import hmac
+import json
+import time
+import jwt
+import pytest
+from fastapi import HTTPException, Request
+from fastapi.responses import StreamingResponse
+from fastapi.security import HTTPAuthorizationCredentials
+from fastapi.testclient import TestClient
+from app import auth, main, rate_limiter
+from app.auth import AuthenticatedUser, create_access_token, get_current_user, get_current_user_dep
+from app.database import API_KEY_USER_ID_SQL, USER_BY_ID_SQL
+from app.rate_limiter import ConcurrencyLimiter, RateLimiter, redis_client
+
+USER = AuthenticatedUser(id=7, tier="free", email="test@example.com", rate_limit=10, max_concurrent=2)
+AUTH = {"Authorization": "Bearer test-token"}
+API_KEY = "sk-test-key"
+API_KEY_HASH = hmac.new(auth.API_KEY_PEPPER, API_KEY.encode(), hashlib.sha256).digest()
+
+endpoint_calls = []
+# Rows returned by the stubbed fetch_row, keyed by (sql, first arg)
+db_rows = {}
+db_calls = []
+
+@main.app.get("/test/concurrency")
+async def concurrency_probe():
+    """Report the in-flight count while the body is still streaming"""
+    async def body():
+        yield str(redis_client.zcard(f"concurrency:user:{USER.id}"))
+    return StreamingResponse(body())
+
+@main.app.get("/test/error")
+async def error_endpoint():
+    endpoint_calls.append(1)
+    raise RuntimeError("endpoint failure")
+
+@pytest.fixture(autouse=True)
+def reset_state():
+    redis_client.flushall()
+    endpoint_calls.clear()
+    yield
+    main.app.dependency_overrides.clear()
+
+@pytest.fixture
+def authed(monkeypatch):
+    """Make the middleware resolve every bearer token to USER"""
+    async def fake_get_current_user(credentials, db):
+        return USER
+    monkeypatch.setattr(main, "get_current_user", fake_get_current_user)
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    """Serve auth lookups from db_rows, recording each query, with cold caches"""
+    async def fake_fetch_row(db, sql, *args):
+        db_calls.append((sql, *args))
+        return db_rows.get((sql, args[0]))
+    monkeypatch.setattr(auth, "fetch_row", fake_fetch_row)
+    db_rows.clear()
+    db_calls.clear()
+    db_rows[(USER_BY_ID_SQL, USER.id)] = {"id": USER.id, "email": USER.email, "tier": USER.tier}
+    db_rows[(API_KEY_USER_ID_SQL, API_KEY_HASH)] = {"user_id": USER.id}
+    for cache in (auth._token_cache, auth._user_cache, auth._apikey_cache):
+        cache.clear()
+
+def authenticate(token):
+    credentials = HTTPAuthorizationCredentials(scheme="Bearer", credentials=token)
+    return asyncio.run(get_current_user(credentials, None))
+
+# Token cache
+
+def test_cached_token_skips_db(fake_db):
+    token = create_access_token(data={"sub": USER.id})
+
+    assert authenticate(token) == USER
+    assert authenticate(token) == USER
+    assert db_calls == [(USER_BY_ID_SQL, USER.id)]
+
+def test_expired_jwt_rejected(fake_db):
+    token = jwt.encode({"sub": str(USER.id), "exp": int(time.time()) - 1}, auth.SECRET_KEY, algorithm=auth.ALGORITHM)
+
+    with pytest.raises(HTTPException) as exc:
+        authenticate(token)
+    assert exc.value.status_code == 401
+    assert db_calls == []
+
+def test_cached_token_not_served_past_exp(fake_db):
+    exp = int(time.time()) + 1
+    token = jwt.encode({"sub": str(USER.id), "exp": exp}, auth.SECRET_KEY, algorithm=auth.ALGORITHM)
+    assert authenticate(token) == USER
+
+    # Still inside TOKEN_CACHE_TTL, but past the token's own exp
+    time.sleep(exp - time.time() + 0.1)
+    with pytest.raises(HTTPException) as exc:
+        authenticate(token)
+    assert exc.value.status_code == 401
+
+def test_failed_lookup_not_cached(fake_db):
+    token = create_access_token(data={"sub": 99})
+
+    for _ in range(2):
+        with pytest.raises(HTTPException) as exc:
+            authenticate(token)
+        assert exc.value.status_code == 401
+    assert db_calls == [(USER_BY_ID_SQL, 99)] * 2
+
+    db_rows[(USER_BY_ID_SQL, 99)] = {"id": 99, "email": "new@example.com", "tier": "pro"}
+    assert authenticate(token).tier == "pro"
+
+# User and API key caches
+
+def test_user_cache_outlives_token_cache(fake_db):
+    token = create_access_token(data={"sub": USER.id})
+    authenticate(token)
+    auth._token_cache.clear()
+
+    assert authenticate(token) == USER
+    assert db_calls == [(USER_BY_ID_SQL, USER.id)]
+
+def test_api_key_looked_up_by_hmac(fake_db):
+    assert authenticate(API_KEY) == USER
+    assert db_calls[0] == (API_KEY_USER_ID_SQL, API_KEY_HASH)
+
+def test_api_key_cache_outlives_token_cache(fake_db):
+    authenticate(API_KEY)
+    auth._token_cache.clear()
+    db_calls.clear()
+
+    assert authenticate(API_KEY) == USER
+    assert db_calls == []
+
+def test_invalidate_user_forces_reload(fake_db):
+    authenticate(API_KEY)
+    db_rows[(USER_BY_ID_SQL, USER.id)]["tier"] = "pro"
+    assert authenticate(API_KEY).tier == "free"
+
+    auth.invalidate_user(USER.id)
+
+    user = authenticate(API_KEY)
+    assert user.tier == "pro"
+    assert user.rate_limit == rate_limiter.limit_for_tier("pro")
+
+def test_invalidate_api_key_forces_reload(fake_db):
+    authenticate(API_KEY)
+    del db_rows[(API_KEY_USER_ID_SQL, API_KEY_HASH)]
+    assert authenticate(API_KEY) == USER
+
+    auth.invalidate_api_key(API_KEY_HASH)
+
+    with pytest.raises(HTTPException) as exc:
+        authenticate(API_KEY)
+    assert exc.value.status_code == 401
+
+# Token bucket
+
+def test_user_bucket_denies_at_limit():
+    limiter = RateLimiter(user_id=1, limit=3)
+    results = [limiter.check() for _ in range(4)]
+
+    assert [allowed for allowed, _ in results] == [True, True, True, False]
+    assert [info["remaining"] for _, info in results] == [2, 1, 0, 0]
+    assert results[-1][1]["error"] == "User rate limit exceeded"
+    assert results[-1][1]["limit"] == 3
+
+def test_bucket_stores_integer_millitokens():
+    RateLimiter(user_id=1, limit=10).check()
+    state = redis_client.hgetall("rate_limit:user:1")
+
+    assert state["tokens_milli"] == "9000"
+    assert state["last_refill_ms"].isdigit()
+    assert 0 < redis_client.pttl("rate_limit:user:1") <= 60000
+
+def test_bucket_refills_over_time():
+    limiter = RateLimiter(user_id=1, limit=10)
+    for _ in range(10):
+        assert limiter.check()[0]
+    assert not limiter.check()[0]
+
+    # 12s at 10/min refills 2 tokens
+    last_refill = int(redis_client.hget("rate_limit:user:1", "last_refill_ms"))
+    redis_client.hset("rate_limit:user:1", "last_refill_ms", last_refill - 12000)
+
+    assert limiter.check()[0]
+    assert limiter.check()[0]
+    assert not limiter.check()[0]
+
+def test_global_limit_checked_after_user(monkeypatch):
+    monkeypatch.setattr(rate_limiter, "GLOBAL_LIMIT", 1)
+
+    assert RateLimiter(user_id=1, limit=10).check()[0]
+    allowed, info = RateLimiter(user_id=2, limit=10).check()
+
+    assert not allowed
+    assert info["error"] == "Global rate limit exceeded"
+    assert info["limit"] == 1
+
+def test_user_denial_does_not_charge_global():
+    limiter = RateLimiter(user_id=1, limit=1)
+    limiter.check()
+    before = redis_client.hget("rate_limit:global", "tokens_milli")
+
+    assert not limiter.check()[0]
+    assert redis_client.hget("rate_limit:global", "tokens_milli") == before
+
+# Concurrency limiter
+
+def test_concurrency_cap_and_release():
+    first = ConcurrencyLimiter(user_id=1, limit=2)
+    second = ConcurrencyLimiter(user_id=1, limit=2)
+    third = ConcurrencyLimiter(user_id=1, limit=2)
+
+    assert first.acquire()
+    assert second.acquire()
+    assert not third.acquire()
+
+    first.release()
+    assert third.acquire()
+
+def test_concurrency_sweeps_stale_requests():
+    seconds, micros = redis_client.time()
+    now_ms = seconds * 1000 + micros // 1000
+    redis_client.zadd("concurrency:user:1", {"leaked": now_ms - 61000})
+
+    assert ConcurrencyLimiter(user_id=1, limit=1).acquire()
+    assert redis_client.zscore("concurrency:user:1", "leaked") is None
+
+def test_middleware_holds_slot_until_body_sent(authed):
+    client = TestClient(main.app)
+
+    response = client.get("/test/concurrency", headers=AUTH)
+
+    assert response.status_code == 200
+    assert response.text == "1"
+    assert redis_client.zcard(f"concurrency:user:{USER.id}") == 0
+
+def test_middleware_rejects_over_concurrency_cap(authed):
+    for i in range(USER.max_concurrent):
+        redis_client.zadd(f"concurrency:user:{USER.id}", {f"held-{i}": redis_client.time()[0] * 1000})
+    client = TestClient(main.app)
+
+    response = client.get("/test/concurrency", headers=AUTH)
+
+    assert response.status_code == 429
+    assert response.json()["error"] == "Concurrent request limit exceeded"
+
+def test_endpoint_error_runs_once_and_releases_slot(authed):
+    client = TestClient(main.app, raise_server_exceptions=False)
+
+    response = client.get("/test/error", headers=AUTH)
+
+    assert response.status_code == 500
+    assert len(endpoint_calls) == 1
+    assert redis_client.zcard(f"concurrency:user:{USER.id}") == 0
+
+def test_cancelled_request_releases_slot(authed):
+    async def cancelled_call_next(request):
+        raise asyncio.CancelledError()
+    request = Request({
+        "type": "http",
+        "method": "GET",
+        "path": "/v1/models",
+        "query_string": b"",
+        "headers": [(b"authorization", AUTH["Authorization"].encode())]
+    })
+
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(main.rate_limit_middleware(request, cancelled_call_next))
+    assert redis_client.zcard(f"concurrency:user:{USER.id}") == 0
+
+# Streaming
+
+def test_stream_frames_are_valid_json(monkeypatch):
+    monkeypatch.setattr(main, "STREAM_TOKEN_INTERVAL", 0)
+    main.app.dependency_overrides[get_current_user_dep] = lambda: USER
+    client = TestClient(main.app)
+    model = 'odd "model" é'
+
+    response = client.post("/v1/chat/completions", json={
+        "model": model,
+        "messages": [{"role": "user", "content": "write python"}],
+        "stream": True
+    })
+    frames = [frame for frame in response.text.split("\n\n") if frame]
+
+    assert response.status_code == 200
+    assert frames[-1] == "data: [DONE]"
+    assert all(frame.startswith("data: ") for frame in frames)
+
+    chunks = [json.loads(frame[6:]) for frame in frames[:-1]]
+    assert len({chunk["id"] for chunk in chunks}) == 1
+    assert all(chunk["model"] == model for chunk in chunks)
+    assert all(chunk["object"] == "chat.completion.chunk" for chunk in chunks)
+    assert "".join(chunk["choices"][0]["delta"]["content"] for chunk in chunks[:-1]) == (
+        "Here's a Python example: def hello(): print('Hello, World!') "
+    )
+    assert all(chunk["choices"][0]["finish_reason"] is None for chunk in chunks[:-1])
+    assert chunks[-1]["choices"][0] == {"index": 0, "delta": {}, "finish_reason": "stop"}
+
+def test_non_stream_usage_counts_whitespace_words():
+    main.app.dependency_overrides[get_current_user_dep] = lambda: USER
+    client = TestClient(main.app)
+
+    response = client.post("/v1/chat/completions", json={
+        "messages": [
+            {"role": "system", "content": "be\nbrief"},
+            {"role": "user", "content": ""},
+            {"role": "user", "content": "tell  me a\tjoke"}
+        ]
+    })
+    usage = response.json()["usage"]
+
+    assert usage["prompt_tokens"] == 6
+    assert usage["completion_tokens"] == 11
+    assert usage["total_tokens"] == 17